@@ -27,6 +27,9 @@ import re
 import os
 import time
 import sys
+import socket
+import threading
+import tempfile
 from StringIO import StringIO
 
 GOOD_CONFIG_FILE = "# This is a good configuration file\n" \
@@ -105,6 +108,53 @@ def open_mock_iter(file_contents, side_effect=None):
     return decorator
 
 
+def make_config(p_links=None, invalid_links=(), rf_flags_dir='/tmp', status_file='/tmp/RPT_STATUS.txt',
+                hosts_file='/tmp/gwys.txt'):
+    links = (p_links or {}).items()
+    links.sort()
+    return persistent_links.Configuration('192.168.1.2', 18998, 'W0QEY', rf_flags_dir, status_file, hosts_file,
+                                          tuple(links), tuple(invalid_links))
+
+
+def all_valid(config, p_links):
+    addresses = {}
+    for (local_module, callsign, remote_module) in p_links.values():
+        addresses[callsign] = ('127.0.0.1', 30001)
+    return addresses, {}
+
+
+def all_reachable(p_links, addresses):
+    reachable = {}
+    for (local_module, callsign, remote_module) in p_links.values():
+        reachable[callsign] = True
+    return reachable
+
+
+def udp_listener(answer, ignore=0):
+    # Binds a local UDP socket which records the packets it receives and optionally echoes one, after ignoring the
+    # first few as if they had been lost
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('127.0.0.1', 0))
+    received = []
+
+    def serve():
+        s.settimeout(1)
+        try:
+            while True:
+                (data, address) = s.recvfrom(1024)
+                received.append(data)
+                if answer and len(received) > ignore:
+                    s.sendto(data, address)
+                    received.append(s.recvfrom(1024)[0])
+                    break
+        except socket.timeout:
+            pass
+
+    t = threading.Thread(target=serve)
+    t.start()
+    return s, t, received
+
+
 @open_mock_iter(GOOD_CONFIG_FILE)
 def lines_normal_test(open_mock):
     result = "".join(persistent_links.lines("Blah"))
@@ -143,48 +193,124 @@ def assignment_statements_matching_data_test(lines_mock):
                                ('K', '8ABs7')], "Some assignment lines were not recognized")
 
 
-@patch('persistent_links.assignment_statements')
-@patch('persistent_links.lines')
-def fetch_configuration_simple_assignments_test(lines_mock, assign_mock):
-    assign_mock.return_value.__iter__ = Mock(return_value=iter([('A', 'B'), ('C', 'D')]))
-    lines_mock.return_value = sentinel.generator
-    result = persistent_links.fetch_configuration("Blah")
-    lines_mock.assert_called_once_with("Blah")
-    assign_mock.assert_called_once_with(sentinel.generator)
-    assert_dict_equal(result, {'A': 'B', 'C': 'D'}, "Results do not match.")
+SNAPSHOT_CONFIG = {'TO_G2_EXTERNAL_IP': '192.168.1.2', 'MY_G2_LINK_PORT': '18998', 'LOGIN_CALL': 'W0QEY',
+                   'RF_FLAGS_DIR': '/tmp', 'STATUS_FILE': '/tmp/RPT_STATUS.txt', 'LINK_AT_STARTUP_A': '',
+                   'LINK_AT_STARTUP_B': 'BXRF721C', 'LINK_AT_STARTUP_C': 'CXRF72lA', 'ANNOUNCE': ['1', '2']}
 
+SNAPSHOT_CONFIG_FILE = "TO_G2_EXTERNAL_IP=192.168.1.2\nMY_G2_LINK_PORT=18998\nLOGIN_CALL=W0QEY\n" \
+                       "RF_FLAGS_DIR=/tmp\nSTATUS_FILE=/tmp/RPT_STATUS.txt\nLINK_AT_STARTUP_B=BXRF721C\n"
 
-@patch('persistent_links.assignment_statements')
-@patch('persistent_links.lines')
-def fetch_configuration_multiple_assignments_test(lines_mock, assign_mock):
-    assign_mock.return_value.__iter__ = Mock(return_value=iter([('A', 'B'), ('A', 'D')]))
-    lines_mock.return_value = sentinel.generator
-    result = persistent_links.fetch_configuration("Blah")
-    lines_mock.assert_called_once_with("Blah")
-    assign_mock.assert_called_once_with(sentinel.generator)
-    assert_dict_equal(result, {'A': ['B', 'D']}, "Results do not match.")
 
+def configuration_values_test():
+    result = persistent_links.configuration_values(iter([('A', 'B'), ('C', 'D'), ('C', 'E')]))
+    assert_dict_equal(result, {'A': 'B', 'C': ['D', 'E']}, "Results do not match.")
 
-@patch('persistent_links.assignment_statements')
-@patch('persistent_links.lines')
-def fetch_configuration_no_assignments_test(lines_mock, assign_mock):
-    assign_mock.return_value.__iter__ = Mock(return_value=iter([]))
-    lines_mock.return_value = sentinel.generator
-    result = persistent_links.fetch_configuration("Blah")
-    lines_mock.assert_called_once_with("Blah")
-    assign_mock.assert_called_once_with(sentinel.generator)
-    assert_dict_equal(result, {}, "Results do not match.")
 
+def compile_configuration_test():
+    result = persistent_links.compile_configuration(SNAPSHOT_CONFIG)
+    nose.tools.eq_(result.gateway_ip, '192.168.1.2')
+    nose.tools.eq_(result.gateway_port, 18998)
+    nose.tools.eq_(result.login_call, 'W0QEY')
+    nose.tools.eq_(result.rf_flags_dir, '/tmp')
+    nose.tools.eq_(result.status_file, '/tmp/RPT_STATUS.txt')
+    nose.tools.eq_(result.hosts_file, os.path.join(persistent_links.G2_LINK_DIRECTORY, 'gwys.txt'))
+    nose.tools.eq_(result.persistent_links, (('B', ('B', 'XRF721', 'C')),))
+    nose.tools.eq_(result.invalid_links, (('C', 'CXRF72lA is not a valid link target'),))
 
-@patch('persistent_links.assignment_statements')
-@patch('persistent_links.lines')
-def fetch_configuration_mixed_assignments_test(lines_mock, assign_mock):
-    assign_mock.return_value.__iter__ = Mock(return_value=iter([('A', 'B'), ('C', 'D'), ('C', 'E')]))
-    lines_mock.return_value = sentinel.generator
-    result = persistent_links.fetch_configuration("Blah")
-    lines_mock.assert_called_once_with("Blah")
-    assign_mock.assert_called_once_with(sentinel.generator)
-    assert_dict_equal(result, {'A': 'B', 'C': ['D', 'E']}, "Results do not match.")
+
+def compile_configuration_hosts_file_test():
+    config = SNAPSHOT_CONFIG.copy()
+    config['GWYS'] = '/tmp/gwys.txt'
+    nose.tools.eq_(persistent_links.compile_configuration(config).hosts_file, '/tmp/gwys.txt',
+                   "Configured host file name incorrect.")
+
+
+def compile_configuration_invalid_target_test():
+    config = SNAPSHOT_CONFIG.copy()
+    config['LINK_AT_STARTUP_A'] = 'AABCDEFGC'
+    result = persistent_links.compile_configuration(config)
+    nose.tools.eq_(result.persistent_links, (('B', ('B', 'XRF721', 'C')),), "Valid modules should not be disabled.")
+    nose.tools.eq_(result.invalid_links, (('A', 'AABCDEFGC is not a valid link target'),
+                                          ('C', 'CXRF72lA is not a valid link target')))
+
+
+@raises(AttributeError)
+def compile_configuration_immutable_test():
+    persistent_links.compile_configuration(SNAPSHOT_CONFIG).login_call = 'N0HAP'
+
+
+def compile_configuration_invalid_test():
+    for (k, v, message) in [('LOGIN_CALL', '', 'LOGIN_CALL is not set'),
+                            ('STATUS_FILE', None, 'STATUS_FILE is not set'),
+                            ('LINK_AT_STARTUP_B', ['BXRF721C', 'BREF001C'], 'LINK_AT_STARTUP_B is set more than once'),
+                            ('MY_G2_LINK_PORT', 'abc', 'MY_G2_LINK_PORT is not a port number: abc')]:
+        config = SNAPSHOT_CONFIG.copy()
+        if v is None:
+            del config[k]
+        else:
+            config[k] = v
+        try:
+            persistent_links.compile_configuration(config)
+        except persistent_links.ConfigurationError, e:
+            nose.tools.eq_(str(e), message)
+        else:
+            raise AssertionError("%s should have been rejected" % k)
+
+
+def write_config_file(directory, contents, mtime):
+    file_name = os.path.join(directory, 'g2_link.cfg')
+    f = open(file_name, 'w')
+    f.write(contents)
+    f.close()
+    os.utime(file_name, (mtime, mtime))
+    return file_name
+
+
+@patch.dict('persistent_links.configuration_cache', clear=True)
+def load_configuration_test():
+    directory = tempfile.mkdtemp()
+    try:
+        file_name = write_config_file(directory, SNAPSHOT_CONFIG_FILE, 1000000)
+        first = persistent_links.load_configuration(file_name)
+        nose.tools.eq_(first.persistent_links, (('B', ('B', 'XRF721', 'C')),))
+        nose.tools.ok_(os.path.exists(file_name + '.cache'), "Snapshot should be written to the cache file.")
+
+        patcher = patch('persistent_links.compile_configuration')
+        compile_mock = patcher.start()
+        try:
+            nose.tools.ok_(persistent_links.load_configuration(file_name) is first,
+                           "Unchanged configuration should be served from memory.")
+            persistent_links.configuration_cache.clear()
+            from_disk = persistent_links.load_configuration(file_name)
+            nose.tools.eq_(from_disk.state(), first.state(), "Snapshot should be served from the cache file.")
+            write_config_file(directory, SNAPSHOT_CONFIG_FILE, 1000060)
+            nose.tools.ok_(persistent_links.load_configuration(file_name) is from_disk,
+                           "Touched configuration with the same content should not be compiled again.")
+        finally:
+            patcher.stop()
+        nose.tools.eq_(compile_mock.called, False, "Configuration should only have been compiled once.")
+
+        write_config_file(directory, SNAPSHOT_CONFIG_FILE.replace('BXRF721C', 'BREF001C'), 1000120)
+        changed = persistent_links.load_configuration(file_name)
+        nose.tools.eq_(changed.persistent_links, (('B', ('B', 'REF001', 'C')),),
+                       "Changed configuration should be compiled again.")
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+@patch.dict('persistent_links.configuration_cache', clear=True)
+@raises(persistent_links.ConfigurationError)
+def load_configuration_invalid_test():
+    directory = tempfile.mkdtemp()
+    try:
+        file_name = write_config_file(directory, SNAPSHOT_CONFIG_FILE + "LOGIN_CALL=N0HAP\n", 1000000)
+        persistent_links.load_configuration(file_name)
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
 
 
 @patch('os.path.getmtime')
@@ -241,7 +367,7 @@ def current_links_invalid_file(open_mock):
 
 
 def rf_file_name_main_modules_test():
-    config = {'RF_FLAGS_DIR': "/usr/blah"}
+    config = make_config(rf_flags_dir="/usr/blah")
     nose.tools.eq_("/usr/blah/local_rf_use_A.txt", persistent_links.rf_file_name(config, 'A'),
                    "Module A file not correct")
     nose.tools.eq_("/usr/blah/local_rf_use_B.txt", persistent_links.rf_file_name(config, 'B'),
@@ -251,7 +377,7 @@ def rf_file_name_main_modules_test():
 
 
 def status_file_name_test():
-    config = {'STATUS_FILE': '/root/g2_link/RPT_STATUS.txt'}
+    config = make_config(status_file='/root/g2_link/RPT_STATUS.txt')
     nose.tools.eq_('/root/g2_link/RPT_STATUS.txt', persistent_links.status_file_name(config),
                    "Status file name incorrect.")
 
@@ -268,6 +394,296 @@ def persistent_links_one_module_link_test():
     assert_dict_equal(result, {'B': ('B', 'XRF721', 'C')})
 
 
+def write_hosts_file(contents, file_name=None, mtime=None):
+    if file_name is None:
+        (fd, file_name) = tempfile.mkstemp()
+        os.close(fd)
+    f = open(file_name, 'w')
+    f.write(contents)
+    f.close()
+    if mtime is not None:
+        os.utime(file_name, (mtime, mtime))
+    return file_name
+
+
+def remove_hosts_file(file_name):
+    for name in (file_name, file_name + '.cache'):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def gateway_host_test():
+    hosts = {}
+    for line in ["# Reflectors\n", "REF001 129.93.2.132 20001\n", "XRF721  204.45.107.21 30001 # comment\n",
+                 "\n", "bogus line\n", "XRF999 1.2.3.4 port\n"]:
+        persistent_links.gateway_host(line, hosts)
+    assert_dict_equal(hosts, {'REF001': ('129.93.2.132', 20001), 'XRF721': ('204.45.107.21', 30001)})
+
+
+@patch.dict('persistent_links.gateway_host_cache', clear=True)
+def gateway_hosts_test():
+    file_name = write_hosts_file("# Reflectors\nREF001 129.93.2.132 20001\nXRF721 204.45.107.21 30001")
+    try:
+        result = persistent_links.gateway_hosts(file_name)
+    finally:
+        remove_hosts_file(file_name)
+    assert_dict_equal(result, {'REF001': ('129.93.2.132', 20001), 'XRF721': ('204.45.107.21', 30001)})
+
+
+@patch.dict('persistent_links.gateway_host_cache', clear=True)
+def gateway_hosts_cached_test():
+    file_name = write_hosts_file("REF001 129.93.2.132 20001\n", mtime=1000000)
+    try:
+        first = persistent_links.gateway_hosts(file_name)
+        patcher = patch('persistent_links.gateway_host')
+        host_mock = patcher.start()
+        try:
+            second = persistent_links.gateway_hosts(file_name)
+            # A later run starts with an empty memory cache, and uses the cache file instead
+            persistent_links.gateway_host_cache.clear()
+            third = persistent_links.gateway_hosts(file_name)
+        finally:
+            patcher.stop()
+    finally:
+        remove_hosts_file(file_name)
+    nose.tools.ok_(first is second, "Unchanged host file should be served from the cache.")
+    nose.tools.eq_(third, first, "Unchanged host file should be served from the cache file.")
+    nose.tools.eq_(host_mock.called, False, "Unchanged host file should not be read again.")
+
+
+@patch.dict('persistent_links.gateway_host_cache', clear=True)
+def gateway_hosts_appended_test():
+    file_name = write_hosts_file("REF001 129.93.2.132 20001\n", mtime=1000000)
+    try:
+        persistent_links.gateway_hosts(file_name)
+        persistent_links.gateway_host_cache.clear()
+        write_hosts_file("REF001 129.93.2.132 20001\nXRF721 204.45.107.21 30001\nREF002 10.0.0.2 20001\n",
+                         file_name, mtime=1000060)
+        patcher = patch('persistent_links.gateway_host', wraps=persistent_links.gateway_host)
+        host_mock = patcher.start()
+        try:
+            result = persistent_links.gateway_hosts(file_name)
+        finally:
+            patcher.stop()
+    finally:
+        remove_hosts_file(file_name)
+    assert_dict_equal(result, {'REF001': ('129.93.2.132', 20001), 'XRF721': ('204.45.107.21', 30001),
+                               'REF002': ('10.0.0.2', 20001)})
+    nose.tools.eq_(host_mock.call_count, 2, "Only the appended lines should be parsed.")
+
+
+@patch.dict('persistent_links.gateway_host_cache', clear=True)
+def gateway_hosts_changed_and_appended_test():
+    file_name = write_hosts_file("REF001 10.0.0.2 20001\nXRF721 204.45.107.21 30001\n", mtime=1000000)
+    try:
+        persistent_links.gateway_hosts(file_name)
+        persistent_links.gateway_host_cache.clear()
+        write_hosts_file("REF001 10.0.0.3 20001\nXRF721 204.45.107.21 30001\nREF002 10.0.0.2 20001\n",
+                         file_name, mtime=1000060)
+        result = persistent_links.gateway_hosts(file_name)
+    finally:
+        remove_hosts_file(file_name)
+    assert_dict_equal(result, {'REF001': ('10.0.0.3', 20001), 'XRF721': ('204.45.107.21', 30001),
+                               'REF002': ('10.0.0.2', 20001)})
+
+
+@patch.dict('persistent_links.gateway_host_cache', clear=True)
+@patch('os.fstat')
+def gateway_hosts_line_being_written_test(fstat_mock):
+    file_name = write_hosts_file("REF001 129.93.2.132 20001\nXRF721 10.0.0.7 300", mtime=1000000)
+    try:
+        # The file grows after it was first examined, so its last line is still being written
+        fstat_mock.return_value = Mock(st_size=os.stat(file_name).st_size + 2)
+        first = persistent_links.gateway_hosts(file_name)
+        fstat_mock.return_value = Mock(st_size=os.stat(file_name).st_size + 3)
+        write_hosts_file("REF001 129.93.2.132 20001\nXRF721 10.0.0.7 30001\n", file_name, mtime=1000060)
+        persistent_links.gateway_host_cache.clear()
+        second = persistent_links.gateway_hosts(file_name)
+    finally:
+        remove_hosts_file(file_name)
+    assert_dict_equal(first, {'REF001': ('129.93.2.132', 20001)})
+    assert_dict_equal(second, {'REF001': ('129.93.2.132', 20001), 'XRF721': ('10.0.0.7', 30001)})
+
+
+@patch.dict('persistent_links.gateway_host_cache', clear=True)
+def gateway_hosts_rewritten_test():
+    file_name = write_hosts_file("REF001 129.93.2.132 20001\nXRF721 204.45.107.21 30001\n", mtime=1000000)
+    try:
+        persistent_links.gateway_hosts(file_name)
+        write_hosts_file("REF002 10.0.0.2 20001\nXRF721 204.45.107.22 30001\nXRF999 10.0.0.9 30001\n",
+                         file_name, mtime=1000060)
+        result = persistent_links.gateway_hosts(file_name)
+    finally:
+        remove_hosts_file(file_name)
+    assert_dict_equal(result, {'REF002': ('10.0.0.2', 20001), 'XRF721': ('204.45.107.22', 30001),
+                               'XRF999': ('10.0.0.9', 30001)})
+
+
+@patch('persistent_links.gateway_hosts')
+def resolve_targets_test(hosts_mock):
+    hosts_mock.return_value = {'REF001': ('129.93.2.132', 20001), 'XRF721': ('204.45.107.21', 30001)}
+    p_links = {'A': ('A', 'REF001', 'C'), 'C': ('C', 'XRF999', 'A')}
+    (addresses, invalid) = persistent_links.resolve_targets(make_config(hosts_file='/tmp/gwys.txt'), p_links)
+    hosts_mock.assert_called_once_with('/tmp/gwys.txt')
+    assert_dict_equal(addresses, {'REF001': ('129.93.2.132', 20001)})
+    assert_dict_equal(invalid, {'C': 'XRF999 is not listed in /tmp/gwys.txt'})
+
+
+@patch('persistent_links.gateway_hosts')
+def resolve_targets_missing_hosts_file_test(hosts_mock):
+    hosts_mock.side_effect = os.error
+    (addresses, invalid) = persistent_links.resolve_targets(make_config(hosts_file='/tmp/gwys.txt'),
+                                                            {'A': ('A', 'REF001', 'C')})
+    assert_dict_equal(addresses, {})
+    assert_dict_equal(invalid, {'A': 'could not read /tmp/gwys.txt to resolve REF001'})
+
+
+@patch('sys.stdout', new_callable=StringIO)
+def report_invalid_targets_once_test(mock_out):
+    (fd, file_name) = tempfile.mkstemp()
+    os.close(fd)
+    os.remove(file_name)
+    try:
+        persistent_links.report_invalid_targets({'B': 'XRF999 is not listed in /tmp/gwys.txt'}, file_name)
+        persistent_links.report_invalid_targets({'B': 'XRF999 is not listed in /tmp/gwys.txt'}, file_name)
+        nose.tools.eq_(mock_out.getvalue(), "Invalid persistent link for module B - XRF999 is not listed in "
+                                            "/tmp/gwys.txt\n", "Invalid target should be reported once.")
+        persistent_links.report_invalid_targets({}, file_name)
+        persistent_links.report_invalid_targets({'B': 'XRF999 is not listed in /tmp/gwys.txt'}, file_name)
+        nose.tools.eq_(mock_out.getvalue().count("module B"), 2, "A problem that returns should be reported again.")
+    finally:
+        os.remove(file_name)
+
+
+@patch('persistent_links.ADMIN', new='N0HAP')
+def probe_packets_test():
+    nose.tools.eq_(persistent_links.probe_packets('REF001', 'C'),
+                   (persistent_links.DPLUS_CONNECT, persistent_links.DPLUS_DISCONNECT), "DPlus probe incorrect")
+    nose.tools.eq_(persistent_links.probe_packets('XRF721', 'C'), ("N0HAP   DC\x00", "N0HAP   D \x00"),
+                   "DExtra probe incorrect")
+
+
+@patch.dict('persistent_links.probe_cache', clear=True)
+@patch('persistent_links.read_cache', new=Mock(return_value=None))
+@patch('persistent_links.write_cache', new=Mock())
+@patch('persistent_links.ADMIN', new='W0QEY')
+def reachable_targets_linked_target_test():
+    (live, live_thread, live_received) = udp_listener(True)
+    try:
+        p_links = {'B': ('B', 'XRF721', 'C')}
+        result = persistent_links.reachable_targets(p_links, {'XRF721': live.getsockname()})
+    finally:
+        live_thread.join()
+        live.close()
+    assert_dict_equal(result, {'XRF721': True})
+    nose.tools.eq_(len(live_received), 2, "Probe should be answered and followed by a disconnect.")
+    for packet in live_received:
+        nose.tools.ok_(not packet.startswith("W0QEY   B"),
+                       "Probing a linked target should never send a request for the linked module: %r" % packet)
+
+
+@patch.dict('persistent_links.probe_cache', clear=True)
+def probe_reachability_local_listeners_test():
+    (live, live_thread, live_received) = udp_listener(True)
+    (dead, dead_thread, dead_received) = udp_listener(False)
+    try:
+        targets = {'REF001': live.getsockname() + ('ping', 'bye'),
+                   'XRF721': dead.getsockname() + ('ping', 'bye')}
+        result = persistent_links.probe_reachability(targets, timeout=0.5)
+    finally:
+        live_thread.join()
+        dead_thread.join()
+        live.close()
+        dead.close()
+    assert_dict_equal(result, {'REF001': True, 'XRF721': False})
+    assert_list_equal(live_received, ['ping', 'bye'], "Answered probe should be followed by the farewell packet")
+    assert_list_equal(dead_received, ['ping'] * persistent_links.PROBE_ATTEMPTS,
+                      "Unanswered probe should be sent PROBE_ATTEMPTS times")
+
+
+@patch.dict('persistent_links.probe_cache', clear=True)
+def probe_reachability_lost_packet_test():
+    (live, live_thread, live_received) = udp_listener(True, ignore=1)
+    try:
+        result = persistent_links.probe_reachability({'REF001': live.getsockname() + ('ping', 'bye')}, timeout=0.5)
+    finally:
+        live_thread.join()
+        live.close()
+    assert_dict_equal(result, {'REF001': True})
+    assert_list_equal(live_received, ['ping', 'ping', 'bye'], "Lost probe should be sent again")
+
+
+@patch.dict('persistent_links.probe_cache', clear=True)
+@patch('socket.socket')
+def probe_reachability_cached_test(socket_mock):
+    persistent_links.probe_cache[('127.0.0.1', 20001)] = (time.time() - 10, True)
+    persistent_links.probe_cache[('127.0.0.1', 30001)] = (time.time() - 10, False)
+    targets = {'REF001': ('127.0.0.1', 20001, 'ping', 'bye'), 'XRF721': ('127.0.0.1', 30001, 'ping', 'bye')}
+    result = persistent_links.probe_reachability(targets, timeout=0.5, ttl=60)
+    assert_dict_equal(result, {'REF001': True, 'XRF721': False})
+    nose.tools.eq_(socket_mock.called, False, "Cached targets should not be probed again.")
+
+
+@patch.dict('persistent_links.probe_cache', clear=True)
+def probe_reachability_expired_test():
+    (dead, dead_thread, dead_received) = udp_listener(False)
+    address = dead.getsockname()
+    persistent_links.probe_cache[address] = (time.time() - 120, True)
+    try:
+        result = persistent_links.probe_reachability({'XRF721': address + ('ping', 'bye')}, timeout=0.5, ttl=60)
+    finally:
+        dead_thread.join()
+        dead.close()
+    assert_dict_equal(result, {'XRF721': False})
+    nose.tools.eq_(persistent_links.probe_cache[address][1], False, "Expired cache entry should be refreshed.")
+
+
+@patch.dict('persistent_links.probe_cache', clear=True)
+def probe_cache_saved_test():
+    (fd, file_name) = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        persistent_links.probe_cache[('127.0.0.1', 20001)] = (time.time() - 10, True)
+        persistent_links.probe_cache[('127.0.0.1', 30001)] = (time.time() - 10 * persistent_links.PROBE_TTL, True)
+        persistent_links.probe_cache[('127.0.0.1', 30002)] = (time.time() - 10, False)
+        persistent_links.save_probe_cache(file_name)
+        persistent_links.probe_cache.clear()
+        persistent_links.load_probe_cache(file_name)
+    finally:
+        os.remove(file_name)
+    nose.tools.eq_(persistent_links.probe_cache.keys(), [('127.0.0.1', 20001)],
+                   "Only unexpired, successful probe results should be reused by later runs.")
+    nose.tools.eq_(persistent_links.probe_cache[('127.0.0.1', 20001)][1], True)
+
+
+def cache_file_test():
+    (fd, file_name) = tempfile.mkstemp()
+    os.write(fd, "not a cache")
+    os.close(fd)
+    try:
+        nose.tools.eq_(persistent_links.read_cache(file_name), None, "Corrupt cache files should be ignored.")
+        persistent_links.write_cache(file_name, {'A': (1, 'B')})
+        nose.tools.eq_(persistent_links.read_cache(file_name), {'A': (1, 'B')}, "Cached data should be read back.")
+    finally:
+        os.remove(file_name)
+    nose.tools.eq_(persistent_links.read_cache(file_name), None, "Missing cache files should be ignored.")
+
+
+@patch('persistent_links.save_probe_cache')
+@patch('persistent_links.load_probe_cache')
+@patch('persistent_links.probe_reachability')
+def reachable_targets_test(probe_mock, load_mock, save_mock):
+    addresses = {'REF001': ('129.93.2.132', 20001)}
+    probe_mock.return_value = {'REF001': True}
+    p_links = {'A': ('A', 'REF001', 'C'), 'B': ('B', 'REF001', 'C'), 'C': ('C', 'XRF999', 'A')}
+    result = persistent_links.reachable_targets(p_links, addresses)
+    nose.tools.eq_(probe_mock.call_count, 1, "Distinct targets should be probed in a single pass.")
+    nose.tools.eq_(probe_mock.call_args[0][0].keys(), ['REF001'], "Only distinct, resolved targets should be probed.")
+    assert_dict_equal(result, {'REF001': True, 'XRF999': False})
+    load_mock.assert_called_once_with(os.path.join(persistent_links.G2_LINK_DIRECTORY, 'persistent_links.probes'))
+    save_mock.assert_called_once_with(os.path.join(persistent_links.G2_LINK_DIRECTORY, 'persistent_links.probes'))
+
+
 def format_gateway_command_test():
     nose.tools.eq_(persistent_links.format_gateway_command('N0HAP', 'B', 'L'), "N0HAP BL", "1x3 Failure")
     nose.tools.eq_(persistent_links.format_gateway_command('KC0SIG', 'C', 'L'), "KC0SIGCL", "2x3 Failure")
@@ -278,7 +694,7 @@ def format_gateway_command_test():
 @patch('subprocess.call')
 def g2link_test_success_test(call_proc):
     cmd = "%s/g2link_test" % persistent_links.G2_LINK_DIRECTORY
-    config = {'TO_G2_EXTERNAL_IP': '192.168.1.2', 'MY_G2_LINK_PORT': '18998', 'LOGIN_CALL': 'W0QEY'}
+    config = make_config()
     persistent_links.g2link_test(config, 'Foo', 'B', "W0QEY BL")
     call_proc.assert_called_once_with([cmd, '192.168.1.2', '18998', "Foo", 'W0QEY', 'B', '20', '2',
                                        persistent_links.ADMIN, 'W0QEY BL'])
@@ -289,7 +705,7 @@ def g2link_test_success_test(call_proc):
 def g2link_test_success_test(exit_proc, call_proc):
     call_proc.side_effect = os.error
     cmd = "%s/g2link_test" % persistent_links.G2_LINK_DIRECTORY
-    config = {'TO_G2_EXTERNAL_IP': '192.168.1.2', 'MY_G2_LINK_PORT': '18998', 'LOGIN_CALL': 'W0QEY'}
+    config = make_config()
     persistent_links.g2link_test(config, 'Foo', 'B', "W0QEY BL")
     call_proc.assert_called_once_with([cmd, '192.168.1.2', '18998', "Foo", 'W0QEY', 'B', '20', '2',
                                        persistent_links.ADMIN, 'W0QEY BL'])
@@ -316,8 +732,9 @@ def unlink_test(format_mock, g2link_mock):
     g2link_mock.assert_called_once_with(sentinel.config, "UNLINK", 'B', '       U')
 
 
-@patch('persistent_links.fetch_configuration')
-@patch('persistent_links.persistent_links')
+@patch('persistent_links.resolve_targets', new=all_valid)
+@patch('persistent_links.reachable_targets', new=all_reachable)
+@patch('persistent_links.load_configuration')
 @patch('persistent_links.minutes_since_modified')
 @patch('persistent_links.link')
 @patch('persistent_links.unlink')
@@ -327,11 +744,10 @@ def unlink_test(format_mock, g2link_mock):
 @patch.dict('persistent_links.RF_TIMERS', values={'A': 15, 'B': 20, 'C': 10})
 @patch('persistent_links.G2_LINK_DIRECTORY', new='/root/g2_link')
 def main_nothing_to_do_test(mock_out, mock_current_links, mock_status_file_name,
-                            mock_unlink, mock_link, mock_minutes, mock_persistent_links, mock_fetch_config):
+                            mock_unlink, mock_link, mock_minutes, mock_load_config):
     mock_current_links.return_value = {'B': ['XRF721', 'C', '204.45.107.21', '020315', '11:50:03']}
     mock_status_file_name.return_value = sentinel.status_file_name
-    mock_fetch_config.return_value = {'RF_FLAGS_DIR': '/tmp'}
-    mock_persistent_links.return_value = {'B': ('B', 'XRF721', 'C')}
+    mock_load_config.return_value = make_config({'B': ('B', 'XRF721', 'C')})
     mock_minutes.return_value = 400
 
     persistent_links.main()
@@ -340,13 +756,13 @@ def main_nothing_to_do_test(mock_out, mock_current_links, mock_status_file_name,
     nose.tools.eq_(mock_unlink.called, False, "Unlink should not have been called.")
     assert_regexp_matches(mock_out.getvalue(), "Nothing to do",
                           "Message did not signal that nothing was to be done.")
-    mock_fetch_config.assert_called_once_with('/root/g2_link/g2_link.cfg')
-    mock_persistent_links.assert_called_once_with(mock_fetch_config.return_value)
+    mock_load_config.assert_called_once_with('/root/g2_link/g2_link.cfg')
     mock_minutes.assert_called_once_with('/tmp/local_rf_use_B.txt')
 
 
-@patch('persistent_links.fetch_configuration')
-@patch('persistent_links.persistent_links')
+@patch('persistent_links.resolve_targets', new=all_valid)
+@patch('persistent_links.reachable_targets', new=all_reachable)
+@patch('persistent_links.load_configuration')
 @patch('persistent_links.minutes_since_modified')
 @patch('persistent_links.link')
 @patch('persistent_links.unlink')
@@ -356,26 +772,25 @@ def main_nothing_to_do_test(mock_out, mock_current_links, mock_status_file_name,
 @patch.dict('persistent_links.RF_TIMERS', values={'A': 15, 'B': 20, 'C': 10})
 @patch('persistent_links.G2_LINK_DIRECTORY', new='/root/g2_link')
 def main_establish_link_test(mock_out, mock_current_links, mock_status_file_name,
-                             mock_unlink, mock_link, mock_minutes, mock_persistent_links, mock_fetch_config):
+                             mock_unlink, mock_link, mock_minutes, mock_load_config):
     mock_current_links.return_value = {}
     mock_status_file_name.return_value = sentinel.status_file_name
-    mock_fetch_config.return_value = {'RF_FLAGS_DIR': '/tmp'}
-    mock_persistent_links.return_value = {'B': ('B', 'XRF721', 'C')}
+    mock_load_config.return_value = make_config({'B': ('B', 'XRF721', 'C')})
     mock_minutes.return_value = 400
 
     persistent_links.main()
 
-    mock_link.assert_called_once_with(mock_fetch_config.return_value, 'B', 'XRF721', 'C')
+    mock_link.assert_called_once_with(mock_load_config.return_value, 'B', 'XRF721', 'C')
     nose.tools.eq_(mock_unlink.called, False, "Unlink should not have been called.")
     assert_regexp_matches(mock_out.getvalue(), "Establish persistent link for module B",
                           "Did not indicate establishing link for module B")
-    mock_fetch_config.assert_called_once_with('/root/g2_link/g2_link.cfg')
-    mock_persistent_links.assert_called_once_with(mock_fetch_config.return_value)
+    mock_load_config.assert_called_once_with('/root/g2_link/g2_link.cfg')
     mock_minutes.assert_called_once_with('/tmp/local_rf_use_B.txt')
 
 
-@patch('persistent_links.fetch_configuration')
-@patch('persistent_links.persistent_links')
+@patch('persistent_links.resolve_targets', new=all_valid)
+@patch('persistent_links.reachable_targets', new=all_reachable)
+@patch('persistent_links.load_configuration')
 @patch('persistent_links.minutes_since_modified')
 @patch('persistent_links.link')
 @patch('persistent_links.unlink')
@@ -385,11 +800,10 @@ def main_establish_link_test(mock_out, mock_current_links, mock_status_file_name
 @patch.dict('persistent_links.RF_TIMERS', values={'A': 15, 'B': 20, 'C': 10})
 @patch('persistent_links.G2_LINK_DIRECTORY', new='/root/g2_link')
 def main_local_machine_active_test(mock_out, mock_current_links, mock_status_file_name,
-                                   mock_unlink, mock_link, mock_minutes, mock_persistent_links, mock_fetch_config):
+                                   mock_unlink, mock_link, mock_minutes, mock_load_config):
     mock_current_links.return_value = {}
     mock_status_file_name.return_value = sentinel.status_file_name
-    mock_fetch_config.return_value = {'RF_FLAGS_DIR': '/tmp'}
-    mock_persistent_links.return_value = {'B': ('B', 'XRF721', 'C')}
+    mock_load_config.return_value = make_config({'B': ('B', 'XRF721', 'C')})
     mock_minutes.return_value = 4
 
     persistent_links.main()
@@ -398,13 +812,13 @@ def main_local_machine_active_test(mock_out, mock_current_links, mock_status_fil
     nose.tools.eq_(mock_unlink.called, False, "Unlink should not have been called.")
     assert_regexp_matches(mock_out.getvalue(), "The gateway for module B is being used",
                           "Did not indicate local RF traffic")
-    mock_fetch_config.assert_called_once_with('/root/g2_link/g2_link.cfg')
-    mock_persistent_links.assert_called_once_with(mock_fetch_config.return_value)
+    mock_load_config.assert_called_once_with('/root/g2_link/g2_link.cfg')
     mock_minutes.assert_called_once_with('/tmp/local_rf_use_B.txt')
 
 
-@patch('persistent_links.fetch_configuration')
-@patch('persistent_links.persistent_links')
+@patch('persistent_links.resolve_targets', new=all_valid)
+@patch('persistent_links.reachable_targets', new=all_reachable)
+@patch('persistent_links.load_configuration')
 @patch('persistent_links.minutes_since_modified')
 @patch('persistent_links.link')
 @patch('persistent_links.unlink')
@@ -414,29 +828,27 @@ def main_local_machine_active_test(mock_out, mock_current_links, mock_status_fil
 @patch.dict('persistent_links.RF_TIMERS', values={'A': 15, 'B': 20, 'C': 10})
 @patch('persistent_links.G2_LINK_DIRECTORY', new='/root/g2_link')
 def main_unlink_other_and_establish_persistent_link_test(mock_out, mock_current_links, mock_status_file_name,
-                                                         mock_unlink, mock_link, mock_minutes, mock_persistent_links,
-                                                         mock_fetch_config):
+                                                         mock_unlink, mock_link, mock_minutes, mock_load_config):
     mock_current_links.return_value = {'B': ['REF001', 'C', '178.45.107.21', '020315', '11:50:03']}
     mock_status_file_name.return_value = sentinel.status_file_name
-    mock_fetch_config.return_value = {'RF_FLAGS_DIR': '/tmp'}
-    mock_persistent_links.return_value = {'B': ('B', 'XRF721', 'C')}
+    mock_load_config.return_value = make_config({'B': ('B', 'XRF721', 'C')})
     mock_minutes.return_value = 400
 
     persistent_links.main()
 
-    mock_unlink.called_once_with(mock_fetch_config.return_value, 'B')
-    mock_link.assert_called_once_with(mock_fetch_config.return_value, 'B', 'XRF721', 'C')
+    mock_unlink.called_once_with(mock_load_config.return_value, 'B')
+    mock_link.assert_called_once_with(mock_load_config.return_value, 'B', 'XRF721', 'C')
     assert_regexp_matches(mock_out.getvalue(),
                           "Unlinking from REF001 and establishing persistent link for module B to "
                           "XRF721, module C",
                           "Did not indicate unlinking and re-linking")
-    mock_fetch_config.assert_called_once_with('/root/g2_link/g2_link.cfg')
-    mock_persistent_links.assert_called_once_with(mock_fetch_config.return_value)
+    mock_load_config.assert_called_once_with('/root/g2_link/g2_link.cfg')
     mock_minutes.assert_called_once_with('/tmp/local_rf_use_B.txt')
 
 
-@patch('persistent_links.fetch_configuration')
-@patch('persistent_links.persistent_links')
+@patch('persistent_links.resolve_targets', new=all_valid)
+@patch('persistent_links.reachable_targets', new=all_reachable)
+@patch('persistent_links.load_configuration')
 @patch('persistent_links.minutes_since_modified')
 @patch('persistent_links.link')
 @patch('persistent_links.unlink')
@@ -445,22 +857,21 @@ def main_unlink_other_and_establish_persistent_link_test(mock_out, mock_current_
 @patch('sys.stdout', new_callable=StringIO)
 @patch.dict('persistent_links.RF_TIMERS', values={'A': 15, 'B': 20, 'C': 10})
 def main_multiple_actions_required_test(mock_out, mock_current_links, mock_status_file_name,
-                                        mock_unlink, mock_link, mock_minutes, mock_persistent_links, mock_fetch_config):
+                                        mock_unlink, mock_link, mock_minutes, mock_load_config):
     mock_current_links.return_value = {'A': ['REF003', 'B', '127.201.100.1', '010516', '12:00:00'],
                                        'B': ['REF001', 'C', '178.45.107.21', '020315', '11:50:03']}
     mock_status_file_name.return_value = sentinel.status_file_name
-    mock_fetch_config.return_value = {'RF_FLAGS_DIR': '/tmp'}
-    mock_persistent_links.return_value = {'A': ('A', 'REF003', 'B'),
-                                          'B': ('B', 'XRF721', 'C'),
-                                          'C': ('C', 'REF008', 'A')}
+    mock_load_config.return_value = make_config({'A': ('A', 'REF003', 'B'),
+                                                 'B': ('B', 'XRF721', 'C'),
+                                                 'C': ('C', 'REF008', 'A')})
 
     mock_minutes.side_effect = lambda x: {'/tmp/local_rf_use_A.txt': 20, '/tmp/local_rf_use_B.txt': 21,
                                           '/tmp/local_rf_use_C.txt': 9}[x]
 
     persistent_links.main()
 
-    mock_unlink.called_once_with(mock_fetch_config.return_value, 'B')
-    mock_link.assert_called_once_with(mock_fetch_config.return_value, 'B', 'XRF721', 'C')
+    mock_unlink.called_once_with(mock_load_config.return_value, 'B')
+    mock_link.assert_called_once_with(mock_load_config.return_value, 'B', 'XRF721', 'C')
     assert_regexp_matches(mock_out.getvalue(),
                           "Nothing to do - persistent link already established for module A",
                           "Nothing should be done for module A, as it is already linked correctly.")
@@ -473,11 +884,321 @@ def main_multiple_actions_required_test(mock_out, mock_current_links, mock_statu
                           "The gateway for module C is being used locally",
                           "A link should not be established for module C, because the machine "
                           "is being used locally on that module.")
-    mock_fetch_config.assert_called_once_with('/root/g2_link/g2_link.cfg')
-    mock_persistent_links.assert_called_once_with(mock_fetch_config.return_value)
+    mock_load_config.assert_called_once_with('/root/g2_link/g2_link.cfg')
     mock_minutes.assert_has_calls([call('/tmp/local_rf_use_A.txt'), call('/tmp/local_rf_use_B.txt'),
                                    call('/tmp/local_rf_use_C.txt')], any_order=True)
 
 
+@patch('persistent_links.resolve_targets', new=all_valid)
+@patch('persistent_links.reachable_targets')
+@patch('persistent_links.load_configuration')
+@patch('persistent_links.minutes_since_modified')
+@patch('persistent_links.link')
+@patch('persistent_links.unlink')
+@patch('persistent_links.status_file_name')
+@patch('persistent_links.current_links')
+@patch('sys.stdout', new_callable=StringIO)
+@patch.dict('persistent_links.RF_TIMERS', values={'A': 15, 'B': 20, 'C': 10})
+def main_unreachable_target_test(mock_out, mock_current_links, mock_status_file_name, mock_unlink, mock_link,
+                                 mock_minutes, mock_load_config, mock_reachable):
+    mock_current_links.return_value = {'B': ['REF001', 'C', '178.45.107.21', '020315', '11:50:03']}
+    mock_status_file_name.return_value = sentinel.status_file_name
+    mock_load_config.return_value = make_config({'A': ('A', 'XRF721', 'C'), 'B': ('B', 'XRF721', 'C')})
+    mock_reachable.return_value = {'XRF721': False}
+    mock_minutes.return_value = 400
+
+    persistent_links.main()
+
+    nose.tools.eq_(mock_link.called, False, "Link should not have been called.")
+    nose.tools.eq_(mock_unlink.called, False, "Unlink should not have been called.")
+    assert_regexp_matches(mock_out.getvalue(), "XRF721 has not answered a reachability probe - not linking module B",
+                          "Should keep the existing link on module B while XRF721 is unreachable")
+    assert_regexp_matches(mock_out.getvalue(), "XRF721 has not answered a reachability probe - not linking module A",
+                          "Should not link module A while XRF721 is unreachable")
+    nose.tools.eq_(mock_reachable.call_count, 1, "Targets should be probed in a single pass.")
+    nose.tools.eq_(mock_reachable.call_args[0][0].keys(), ['XRF721'], "Each distinct target should be probed once.")
+
+
+@patch('persistent_links.report_invalid_targets', new=Mock())
+@patch('persistent_links.resolve_targets')
+@patch('persistent_links.reachable_targets', new=all_reachable)
+@patch('persistent_links.load_configuration')
+@patch('persistent_links.minutes_since_modified')
+@patch('persistent_links.link')
+@patch('persistent_links.current_links')
+@patch('sys.stdout', new_callable=StringIO)
+@patch.dict('persistent_links.RF_TIMERS', values={'A': 15, 'B': 20, 'C': 10})
+def main_target_removed_after_plan_test(mock_out, mock_current_links, mock_link, mock_minutes, mock_load_config,
+                                        mock_resolve):
+    mock_current_links.return_value = {}
+    mock_load_config.return_value = make_config({'A': ('A', 'XRF721', 'C')})
+    mock_resolve.side_effect = [({'XRF721': ('10.0.0.7', 30001)}, {}),
+                                ({}, {'XRF721': 'XRF721 is not listed in gwys.txt'})]
+    mock_minutes.return_value = 400
+
+    persistent_links.main()
+
+    nose.tools.eq_(mock_link.called, False, "Link should not have been called.")
+    assert_regexp_matches(mock_out.getvalue(), "XRF721 has not answered a reachability probe - not linking module A",
+                          "A target removed from gwys.txt after planning should not be linked")
+
+
+@patch('persistent_links.report_invalid_targets')
+@patch('persistent_links.resolve_targets')
+@patch('persistent_links.reachable_targets', new=all_reachable)
+@patch('persistent_links.load_configuration')
+@patch('persistent_links.minutes_since_modified')
+@patch('persistent_links.link')
+@patch('persistent_links.unlink')
+@patch('persistent_links.status_file_name')
+@patch('persistent_links.current_links')
+@patch('sys.stdout', new_callable=StringIO)
+@patch.dict('persistent_links.RF_TIMERS', values={'A': 15, 'B': 20, 'C': 10})
+def main_invalid_target_test(mock_out, mock_current_links, mock_status_file_name, mock_unlink, mock_link,
+                             mock_minutes, mock_load_config, mock_resolve, mock_report):
+    mock_current_links.return_value = {'B': ['REF001', 'C', '178.45.107.21', '020315', '11:50:03']}
+    mock_status_file_name.return_value = sentinel.status_file_name
+    mock_load_config.return_value = make_config({'A': ('A', 'XRF721', 'C'), 'B': ('B', 'XRF999', 'C')})
+    mock_resolve.return_value = ({'XRF721': ('204.45.107.21', 30001)},
+                                 {'B': 'XRF999 is not listed in /root/g2_link/gwys.txt'})
+    mock_minutes.return_value = 400
+
+    persistent_links.main()
+
+    mock_link.assert_called_once_with(mock_load_config.return_value, 'A', 'XRF721', 'C')
+    nose.tools.eq_(mock_unlink.called, False, "Unlink should not have been called.")
+    mock_report.assert_called_once_with({'B': 'XRF999 is not listed in /root/g2_link/gwys.txt'},
+                                        os.path.join(persistent_links.G2_LINK_DIRECTORY, 'persistent_links.reported'))
+    mock_minutes.assert_called_once_with('/tmp/local_rf_use_A.txt')
+
+
+@patch('persistent_links.resolve_targets')
+@patch('persistent_links.reachable_targets')
+@patch('persistent_links.minutes_since_modified')
+@patch('persistent_links.link')
+@patch('persistent_links.current_links')
+@patch('sys.stdout', new_callable=StringIO)
+@patch.dict('persistent_links.RF_TIMERS', values={'A': 15, 'B': 20, 'C': 10, 'D': 10})
+def plan_test(mock_out, mock_current_links, mock_link, mock_minutes, mock_reachable,
+              mock_resolve):
+    config = make_config({'A': ('A', 'REF003', 'B'), 'B': ('B', 'XRF721', 'C'),
+                          'C': ('C', 'REF008', 'A'), 'D': ('D', 'XRF999', 'A')})
+    mock_current_links.return_value = {'A': ['REF003', 'B', '127.201.100.1', '010516', '12:00:00'],
+                                       'B': ['REF001', 'C', '178.45.107.21', '020315', '11:50:03']}
+    mock_resolve.return_value = ({'REF003': ('10.0.0.3', 20001), 'XRF721': ('10.0.0.7', 30001),
+                                  'REF008': ('10.0.0.8', 20001)}, {'D': 'XRF999 is not listed in gwys.txt'})
+    mock_reachable.return_value = {'REF003': True, 'XRF721': True, 'REF008': True}
+    mock_minutes.side_effect = lambda x: {'/tmp/local_rf_use_A.txt': 20, '/tmp/local_rf_use_B.txt': 21,
+                                          '/tmp/local_rf_use_C.txt': 9}[x]
+
+    result = persistent_links.plan(config)
+
+    nose.tools.eq_(result['gateway'], 'W0QEY', "Plan should identify the gateway.")
+    nose.tools.eq_([(a['module'], a['action'], a['current']) for a in result['actions']],
+                   [('A', 'none', 'REF003'), ('B', 'relink', 'REF001'), ('C', 'wait', None), ('D', 'invalid', None)],
+                   "Plan actions incorrect.")
+    nose.tools.eq_(result['actions'][1]['reason'], "Unlinking from REF001 and establishing persistent link for "
+                                                   "module B to XRF721, module C", "Relink reason incorrect.")
+    nose.tools.eq_(mock_reachable.called, False, "Planning should not probe targets.")
+    nose.tools.eq_(mock_link.called, False, "Planning should not send commands.")
+    nose.tools.eq_(mock_out.getvalue(), "", "Planning should not print anything.")
+
+
+@patch('persistent_links.load_configuration')
+@patch('persistent_links.plan')
+@patch('persistent_links.execute')
+@patch('sys.stdout', new_callable=StringIO)
+def main_plan_command_test(mock_out, mock_execute, mock_plan, mock_load_config):
+    mock_plan.return_value = {'gateway': 'W0QEY', 'actions': [
+        {'module': 'B', 'action': 'link', 'target': 'XRF721', 'remote_module': 'C', 'current': None,
+         'reason': 'Establish persistent link for module B'}]}
+
+    persistent_links.main(['plan'])
+
+    nose.tools.eq_(mock_execute.called, False, "The plan command should not execute actions.")
+    nose.tools.eq_(persistent_links.json.loads(mock_out.getvalue()), mock_plan.return_value,
+                   "The plan command should print the plan as JSON.")
+    nose.tools.eq_(mock_out.getvalue(), persistent_links.json.dumps(mock_plan.return_value, sort_keys=True,
+                                                                    indent=2) + "\n", "Plan output should be sorted.")
+
+
+def load_plan_test():
+    (fd, file_name) = tempfile.mkstemp()
+    os.write(fd, '{"gateway": "W0QEY", "actions": [{"module": "B", "action": "link", "target": "XRF721", '
+                 '"remote_module": "C", "current": null, "reason": "Establish persistent link for module B"}]}')
+    os.close(fd)
+    try:
+        result = persistent_links.load_plan(file_name)
+    finally:
+        os.remove(file_name)
+    nose.tools.eq_(result, {'gateway': 'W0QEY', 'actions': [
+        {'module': 'B', 'action': 'link', 'target': 'XRF721', 'remote_module': 'C', 'current': None,
+         'reason': 'Establish persistent link for module B'}]})
+    nose.tools.eq_(type(result['actions'][0]['target']), str, "Plan text should be loaded as plain strings.")
+
+
+def load_plan_invalid_test():
+    good = '{"module": "B", "action": "link", "target": "XRF721", "remote_module": "C", "current": null, ' \
+           '"reason": "Establish"}'
+    for (contents, message) in [('{"gateway": "W0QEY", "actions": [', 'Invalid plan'),
+                                ('{"gateway": "W0QEY"}', 'a plan must be an object with gateway and actions'),
+                                ('{"gateway": "W0QEY", "actions": [%s]}' % good.replace('"current": null, ', ''),
+                                 'an action has no current'),
+                                ('{"gateway": "W0QEY", "actions": [%s]}' % good.replace('"B"', '"D"'),
+                                 'unknown module D'),
+                                ('{"gateway": "W0QEY", "actions": [%s]}' % good.replace('"link"', '"explode"'),
+                                 'unknown action explode for module B'),
+                                ('{"gateway": "W0QEY", "actions": [%s]}' % good.replace('XRF721', 'XRF72\\u00e9'),
+                                 'the target of an action must be ASCII text'),
+                                ('{"gateway": "W0QEY", "actions": [%s]}' % good.replace('"C"', '"CC"'),
+                                 'XRF721CC is not a valid link target for module B'),
+                                ('{"gateway": "W0QEY", "actions": [%s]}' % good.replace('XRF721', 'ABCDEFG'),
+                                 'ABCDEFGC is not a valid link target for module B')]:
+        (fd, file_name) = tempfile.mkstemp()
+        os.write(fd, contents)
+        os.close(fd)
+        try:
+            try:
+                persistent_links.load_plan(file_name)
+            except SystemExit, e:
+                assert_regexp_matches(str(e), re.escape(message))
+            else:
+                raise AssertionError("%s should have been rejected" % contents)
+        finally:
+            os.remove(file_name)
+
+
+@raises(SystemExit)
+def load_plan_missing_file_test():
+    persistent_links.load_plan('/nonexistent/plan.json')
+
+
+def plan_action(module, action, target, current=None):
+    return {'module': module, 'action': action, 'target': target, 'remote_module': 'C', 'current': current,
+            'reason': "%s module %s to %s" % (action, module, target)}
+
+
+@patch('persistent_links.resolve_targets', new=all_valid)
+@patch('persistent_links.reachable_targets', new=all_reachable)
+@patch('persistent_links.minutes_since_modified')
+@patch('persistent_links.link')
+@patch('persistent_links.unlink')
+@patch('persistent_links.current_links')
+@patch('sys.stdout', new_callable=StringIO)
+@patch.dict('persistent_links.RF_TIMERS', values={'A': 15, 'B': 20, 'C': 10})
+def apply_plans_test(mock_out, mock_current_links, mock_unlink, mock_link, mock_minutes):
+    config = make_config()
+    mock_link.return_value = 0
+    mock_current_links.return_value = {'A': ['REF003', 'B', '127.201.100.1', '010516', '12:00:00'],
+                                       'B': ['REF001', 'C', '178.45.107.21', '020315', '11:50:03']}
+    mock_minutes.side_effect = lambda x: {'/tmp/local_rf_use_A.txt': 20, '/tmp/local_rf_use_B.txt': 21,
+                                          '/tmp/local_rf_use_C.txt': 11}[x]
+    plans = [{'gateway': 'W0QEY', 'actions': [plan_action('A', 'none', 'REF003', 'REF003'),
+                                              plan_action('B', 'relink', 'XRF721', 'REF001'),
+                                              plan_action('C', 'link', 'REF008')]},
+             {'gateway': 'W0QEY', 'actions': [plan_action('B', 'relink', 'XRF721', 'REF001'),
+                                              plan_action('B', 'relink', 'XRF757', 'REF001'),
+                                              plan_action('A', 'relink', 'REF008', 'REF002')]},
+             {'gateway': 'KC0SIG', 'actions': [plan_action('A', 'link', 'REF001')]}]
+
+    result = persistent_links.apply_plans(config, plans)
+
+    nose.tools.eq_(result, 2, "Two actions should have been executed.")
+    mock_unlink.assert_called_once_with(config, 'B')
+    nose.tools.eq_(mock_link.call_args_list, [call(config, 'B', 'XRF721', 'C'), call(config, 'C', 'REF008', 'C')])
+    assert_regexp_matches(mock_out.getvalue(), "Skipping relink of module B to XRF757 - module is no longer linked "
+                                               "to REF001", "Conflicting action should be skipped.")
+    assert_regexp_matches(mock_out.getvalue(), "Skipping relink of module A to REF008 - module is no longer linked "
+                                               "to REF002", "Stale action should be skipped.")
+    assert_regexp_matches(mock_out.getvalue(), "Skipping plan for gateway KC0SIG",
+                          "Plans for other gateways should be skipped.")
+    mock_current_links.assert_called_once_with('/tmp/RPT_STATUS.txt')
+
+
+@patch('persistent_links.resolve_targets', new=all_valid)
+@patch('persistent_links.reachable_targets')
+@patch('persistent_links.minutes_since_modified')
+@patch('persistent_links.link')
+@patch('persistent_links.current_links')
+@patch('sys.stdout', new_callable=StringIO)
+@patch.dict('persistent_links.RF_TIMERS', values={'A': 15, 'B': 20, 'C': 10})
+def apply_plans_preconditions_test(mock_out, mock_current_links, mock_link, mock_minutes, mock_reachable):
+    config = make_config()
+    mock_current_links.return_value = {'C': ['REF001', 'C', '178.45.107.21', '020315', '11:50:03']}
+    mock_minutes.side_effect = lambda x: {'/tmp/local_rf_use_A.txt': 5, '/tmp/local_rf_use_B.txt': 21,
+                                          '/tmp/local_rf_use_C.txt': 11}[x]
+    mock_reachable.return_value = {'REF003': True, 'XRF721': False, 'REF008': True}
+    plans = [{'gateway': 'W0QEY', 'actions': [plan_action('A', 'link', 'REF003'), plan_action('B', 'link', 'XRF721'),
+                                              plan_action('C', 'link', 'REF008')]}]
+
+    result = persistent_links.apply_plans(config, plans)
+
+    nose.tools.eq_(result, 0, "No actions should have been executed.")
+    nose.tools.eq_(mock_link.called, False, "Link should not have been called.")
+    assert_regexp_matches(mock_out.getvalue(), "Skipping link of module A to REF003 - the gateway is being used "
+                                               "locally", "Action for a module in local use should be skipped.")
+    assert_regexp_matches(mock_out.getvalue(), "Skipping link of module B to XRF721 - XRF721 has not answered",
+                          "Action for an unreachable target should be skipped.")
+    assert_regexp_matches(mock_out.getvalue(), "Skipping link of module C to REF008 - module is now linked to REF001",
+                          "Action for a module that has been linked since planning should be skipped.")
+
+
+@patch('persistent_links.resolve_targets', new=all_valid)
+@patch('persistent_links.reachable_targets')
+@patch('persistent_links.minutes_since_modified')
+@patch('persistent_links.link')
+@patch('persistent_links.unlink')
+@patch('persistent_links.current_links')
+@patch('sys.stdout', new_callable=StringIO)
+@patch.dict('persistent_links.RF_TIMERS', values={'A': 15, 'B': 20, 'C': 10})
+def apply_plans_failed_link_test(mock_out, mock_current_links, mock_unlink, mock_link, mock_minutes,
+                                 mock_reachable):
+    config = make_config()
+    mock_current_links.side_effect = [{'B': ['REF001', 'C', '178.45.107.21', '020315', '11:50:03']}, {}]
+    mock_minutes.return_value = 400
+    mock_reachable.side_effect = all_reachable
+    mock_link.return_value = 1
+    plans = [{'gateway': 'W0QEY', 'actions': [plan_action('B', 'relink', 'XRF721', 'REF001'),
+                                              plan_action('B', 'relink', 'XRF757', 'REF001'),
+                                              plan_action('C', 'relink', 'REF008', 'REF002')]}]
+
+    result = persistent_links.apply_plans(config, plans)
+
+    nose.tools.eq_(result, 0, "A failed link should not be counted.")
+    mock_link.assert_called_once_with(config, 'B', 'XRF721', 'C')
+    assert_regexp_matches(mock_out.getvalue(), "Failed to relink module B to XRF721 - g2link_test returned 1",
+                          "Failed link should be reported.")
+    assert_regexp_matches(mock_out.getvalue(), "Skipping relink of module B to XRF757 - module is no longer linked "
+                                               "to REF001", "Status should be read again after a failed link.")
+    nose.tools.eq_(mock_current_links.call_count, 2, "Status should be read again after a failed link.")
+    nose.tools.eq_(sorted(mock_reachable.call_args[0][1].keys()), ['XRF721', 'XRF757'],
+                   "Only targets of actions whose other preconditions hold should be probed.")
+
+
+@patch('persistent_links.load_configuration')
+@patch('persistent_links.load_plan')
+@patch('persistent_links.apply_plans')
+@patch('sys.stdout', new_callable=StringIO)
+def main_apply_command_test(mock_out, mock_apply, mock_load, mock_load_config):
+    mock_load.side_effect = lambda x: {'/tmp/a.json': sentinel.plan_a, '/tmp/b.json': sentinel.plan_b}[x]
+
+    persistent_links.main(['apply', '/tmp/a.json', '/tmp/b.json'])
+
+    mock_apply.assert_called_once_with(mock_load_config.return_value, [sentinel.plan_a, sentinel.plan_b])
+
+
+@raises(SystemExit)
+@patch('persistent_links.load_configuration')
+def main_unknown_command_test(mock_load_config):
+    persistent_links.main(['relink'])
+
+
+@raises(SystemExit)
+@patch('persistent_links.load_configuration')
+def main_invalid_configuration_test(mock_load_config):
+    mock_load_config.side_effect = persistent_links.ConfigurationError("LOGIN_CALL is not set")
+    persistent_links.main()
+
+
 if __name__ == "__main__":
     nose.main()
\ No newline at end of file
@@ -27,6 +27,22 @@ import time
 import csv
 import subprocess
 import sys
+import socket
+import select
+import marshal
+try:
+    from hashlib import md5
+except ImportError:
+    # Python 2.4 does not include hashlib
+    from md5 import md5
+try:
+    import json
+except ImportError:
+    # Python 2.4 and 2.5 do not include json, but simplejson provides the same interface
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
 
 # These variables may be configured for a particular installation.
 # G2_LINK_DIRECTORY - should be the full path to the directory where the g2_link program, its configuration files,
@@ -40,6 +56,56 @@ G2_LINK_DIRECTORY = "/root/g2_link"
 RF_TIMERS = {'A': 15, 'B': 20, 'C': 10}
 ADMIN = "N0HAP"
 
+# PROBE_TIMEOUT     - The number of seconds to wait for reflectors/gateways to answer a reachability probe.
+# PROBE_ATTEMPTS    - The number of times a probe is sent, evenly spread over PROBE_TIMEOUT, in case one is lost.
+# PROBE_TTL         - The number of seconds a successful probe result is cached before the target is probed again.
+
+PROBE_TIMEOUT = 3
+PROBE_ATTEMPTS = 3
+PROBE_TTL = 300
+
+# DPlus (REF) reflectors answer a connect request by echoing it; the disconnect request releases the connection.
+# Probes are sent from a new UDP port, so the reflector treats them as a client separate from g2_link.
+DPLUS_CONNECT = "\x05\x00\x18\x00\x01"
+DPLUS_DISCONNECT = "\x05\x00\x18\x00\x00"
+
+# DExtra reflectors identify clients by callsign and module, so probes connect (and then disconnect) as the ADMIN
+# callsign on a module that is never persistently linked, which cannot change the state of our own links.
+PROBE_MODULE = 'D'
+
+# Cache of probe results, keyed by (address, port), with values of (time probed, reachable).  Successful results
+# are saved in PROBE_CACHE_FILE, in G2_LINK_DIRECTORY, so that they are reused by later runs.
+probe_cache = {}
+PROBE_CACHE_FILE = "persistent_links.probes"
+
+# Version of the binary cache file format written by write_cache.
+CACHE_VERSION = 2
+
+# Cache of reflector/gateway host indexes, keyed by file name, with values of (modification time, size,
+# length of the complete lines parsed, md5 digest of those lines, host index).  The digest is None when the index
+# also includes a final line without a newline.  Each index is also saved in a cache file (the host file name with
+# .cache appended), so that later runs only read the host file when it changes.
+gateway_host_cache = {}
+
+# File, in G2_LINK_DIRECTORY, listing the invalid persistent links that have already been reported.
+REPORTED_TARGETS_FILE = "persistent_links.reported"
+
+# Cache of compiled configuration snapshots, keyed by file name, with values of (modification time, size,
+# content digest, snapshot).
+configuration_cache = {}
+
+# The configuration variables the script requires.
+REQUIRED_CONFIG_KEYS = ("TO_G2_EXTERNAL_IP", "MY_G2_LINK_PORT", "LOGIN_CALL", "RF_FLAGS_DIR", "STATUS_FILE")
+
+# The fields and kinds of the actions in a plan.
+PLAN_ACTION_KEYS = ('module', 'action', 'target', 'remote_module', 'current', 'reason')
+PLAN_ACTIONS = ('link', 'relink', 'none', 'wait', 'invalid')
+
+# A link target is a single letter module and a callsign/reflector id of up to 6 characters, which is all that fits
+# in a URCALL before the remote module and command.
+MODULE = re.compile('^[A-Z]$')
+CALLSIGN = re.compile('^[A-Z0-9]{3,6}$')
+
 
 def lines(file_name):
     """
@@ -57,6 +123,46 @@ def lines(file_name):
     f.close()
 
 
+def read_cache(file_name):
+    """
+    Reads data from a binary cache file, written by write_cache.
+    :param file_name: The file name, including the full path, of the cache file.
+    :return: The cached data, or None if the cache file is missing, unreadable or from another version.
+    """
+    try:
+        f = open(file_name, 'rb')
+        try:
+            (version, data) = marshal.load(f)
+        finally:
+            f.close()
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if version != CACHE_VERSION:
+        return None
+    return data
+
+
+def write_cache(file_name, data):
+    """
+    Writes data to a binary cache file, replacing it atomically.  Failures are ignored, as a cache only saves work.
+    :param file_name: The file name, including the full path, of the cache file.
+    :param data: The data to be cached, made up of types supported by marshal.
+    """
+    temp_file_name = "%s.%d" % (file_name, os.getpid())
+    try:
+        f = open(temp_file_name, 'wb')
+        try:
+            marshal.dump((CACHE_VERSION, data), f)
+        finally:
+            f.close()
+        os.rename(temp_file_name, file_name)
+    except (IOError, os.error):
+        try:
+            os.remove(temp_file_name)
+        except os.error:
+            pass
+
+
 def assignment_statements(gen):
     """
     Generator producing tuples containing the left and right hand sides of assignment, for each line that contains
@@ -72,15 +178,15 @@ def assignment_statements(gen):
             yield m.groups()
 
 
-def fetch_configuration(file_name):
+def configuration_values(gen):
     """
-    Parses a g2_link configuration file and produces a dictionary containing all variable values. Overlapping
-    assignments result in a right hand side (dictionary value) which is a list of values.
-    :param file_name: The file name, including the full path.
+    Produces a dictionary containing all variable values from assignments.  Overlapping assignments result in a right
+    hand side (dictionary value) which is a list of values.
+    :param gen: The generator that produces tuples containing the left and right hand sides of assignments
     :return: Dictionary containing variable names (keys) and assigned values
     """
     config = {}
-    for (k, v) in assignment_statements(lines(file_name)):
+    for (k, v) in gen:
         if k in config:
             if type(config[k]) is not list:
                 config[k] = [config[k]]
@@ -91,6 +197,116 @@ def fetch_configuration(file_name):
     return config
 
 
+class ConfigurationError(Exception):
+    """
+    Raised when the g2_link configuration is missing, or has ambiguous or malformed, values required by this script.
+    """
+    pass
+
+
+class Configuration(object):
+    """
+    Immutable, validated snapshot of the g2_link configuration values used by this script, as produced by
+    compile_configuration.  Persistent links are tuples of (module, (local module, destination machine, destination
+    module)), and persistent links that are not valid are tuples of (module, reason).
+    """
+    __slots__ = ('gateway_ip', 'gateway_port', 'login_call', 'rf_flags_dir', 'status_file', 'hosts_file',
+                 'persistent_links', 'invalid_links')
+
+    def __init__(self, gateway_ip, gateway_port, login_call, rf_flags_dir, status_file, hosts_file, persistent_links,
+                 invalid_links):
+        state = (gateway_ip, gateway_port, login_call, rf_flags_dir, status_file, hosts_file, persistent_links,
+                 invalid_links)
+        for (name, value) in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Configuration snapshots cannot be modified")
+
+    def state(self):
+        """
+        Produces the contents of the snapshot, suitable for serialization with marshal.
+        :return: Tuple containing the constructor arguments of the snapshot.
+        """
+        return tuple([getattr(self, name) for name in self.__slots__])
+
+
+def compile_configuration(config):
+    """
+    Validates the configuration variables used by this script, including the persistent link targets, and compiles
+    them into an immutable snapshot.  A persistent link target that is not valid only disables its own module.
+    :param config: Dictionary containing the configuration variables for the g2_link system
+    :return: Configuration snapshot
+    """
+    for k in REQUIRED_CONFIG_KEYS:
+        if k not in config or config[k] == "":
+            raise ConfigurationError("%s is not set" % k)
+    for k in REQUIRED_CONFIG_KEYS + ("GWYS", "LINK_AT_STARTUP_A", "LINK_AT_STARTUP_B", "LINK_AT_STARTUP_C"):
+        if k in config and type(config[k]) is list:
+            raise ConfigurationError("%s is set more than once" % k)
+    if not config["MY_G2_LINK_PORT"].isdigit():
+        raise ConfigurationError("MY_G2_LINK_PORT is not a port number: %s" % config["MY_G2_LINK_PORT"])
+
+    hosts_file = os.path.join(G2_LINK_DIRECTORY, "gwys.txt")
+    if "GWYS" in config and config["GWYS"] != "":
+        hosts_file = config["GWYS"]
+
+    p_links = []
+    invalid = []
+    targets = persistent_links(config)
+    modules = targets.keys()
+    modules.sort()
+    for module in modules:
+        (local_module, callsign, remote_module) = targets[module]
+        if MODULE.match(local_module) and CALLSIGN.match(callsign) and MODULE.match(remote_module):
+            p_links.append((module, targets[module]))
+        else:
+            invalid.append((module, "%s is not a valid link target" % config["LINK_AT_STARTUP_%s" % module]))
+
+    return Configuration(config["TO_G2_EXTERNAL_IP"], int(config["MY_G2_LINK_PORT"]), config["LOGIN_CALL"],
+                         config["RF_FLAGS_DIR"], config["STATUS_FILE"], hosts_file, tuple(p_links), tuple(invalid))
+
+
+def load_configuration(file_name):
+    """
+    Produces a validated snapshot of a g2_link configuration file, compiling it only when the file has changed.
+    Snapshots are cached in memory and in a binary cache file (the configuration file name with .cache appended),
+    keyed by the file modification time, size and content digest.  A long-running process may call this each time
+    it needs the configuration, to pick up a new snapshot when the file changes.
+    :param file_name: The file name, including the full path.
+    :return: Configuration snapshot
+    """
+    st = os.stat(file_name)
+    cache_file_name = file_name + ".cache"
+    cached = configuration_cache.get(file_name)
+    if cached is None:
+        saved = read_cache(cache_file_name)
+        try:
+            (mtime, size, digest, state) = saved
+            cached = (mtime, size, digest, Configuration(*state))
+        except (TypeError, ValueError):
+            cached = None
+    if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        configuration_cache[file_name] = cached
+        return cached[3]
+
+    # Could not use with open(file_name) as f: ... since this must run on Python 2.4
+    f = open(file_name)
+    try:
+        content = f.read()
+    finally:
+        f.close()
+    digest = md5(content).hexdigest()
+    if cached and cached[2] == digest:
+        snapshot = cached[3]
+    else:
+        snapshot = compile_configuration(configuration_values(assignment_statements(content.splitlines(True))))
+
+    configuration_cache[file_name] = (st.st_mtime, st.st_size, digest, snapshot)
+    write_cache(cache_file_name, (st.st_mtime, st.st_size, digest, snapshot.state()))
+    return snapshot
+
+
 def minutes_since_modified(file_name):
     """Calculates the number of minutes since a file was last modified, or produces a large number if the file
     doesn't exist.
@@ -128,20 +344,20 @@ def current_links(file_name):
 def rf_file_name(config, module):
     """
     Produces the full path to the rf local use file for a particular module
-    :param config: Dictionary containing the configuration variables for the g2_link system
+    :param config: Configuration snapshot for the g2_link system
     :param module: Single letter module identifier (e.g., A, B, C)
     :return: The file name, including the full path, for the rf local use file.
     """
-    return os.path.join(config["RF_FLAGS_DIR"], "local_rf_use_%s.txt" % module)
+    return os.path.join(config.rf_flags_dir, "local_rf_use_%s.txt" % module)
 
 
 def status_file_name(config):
     """
     Produces the full path and file name for the repeater status file, where active links are stored.
-    :param config: Dictionary containing the configuration variables for the g2_link system
+    :param config: Configuration snapshot for the g2_link system
     :return: The file name, including the full path, for the repeater status file.
     """
-    return config["STATUS_FILE"]
+    return config.status_file
 
 
 def persistent_links(config):
@@ -160,6 +376,258 @@ def persistent_links(config):
     return p_links
 
 
+def gateway_host(line, hosts):
+    """
+    Adds the reflector/gateway described by a line of the g2_link host file to a host index.
+    :param line: A line of the host file, of the form: callsign ip_address port
+    :param hosts: Dictionary containing callsign/reflector id (key) and tuple value of (ip address, port).  Blank
+    lines, comments and malformed lines leave it unchanged.
+    """
+    items = line.split("#", 1)[0].split()
+    if len(items) == 3 and items[2].isdigit():
+        hosts[items[0]] = (items[1], int(items[2]))
+
+
+def gateway_hosts(file_name):
+    """
+    Produces an index (dictionary) of reflectors/gateways to their addresses, as listed in the g2_link host file.
+    The index is cached, in memory and in a cache file, by file modification time and size.  When the file has grown
+    and the lines already parsed are unchanged, just the appended lines are parsed; otherwise, the whole file is read
+    again.  A line without a newline is only indexed at the end of a file that is not being written.
+    :param file_name: File name, including path, of the reflector/gateway host list.
+    :return: Dictionary containing callsign/reflector id (key) and tuple value of (ip address, port).
+    """
+    st = os.stat(file_name)
+    cache_file_name = file_name + ".cache"
+    cached = gateway_host_cache.get(file_name)
+    if cached is None:
+        cached = read_cache(cache_file_name)
+        if type(cached) is not tuple or len(cached) != 5:
+            cached = None
+    if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        gateway_host_cache[file_name] = cached
+        return cached[4]
+
+    hosts = None
+    # Could not use with open(file_name) as f: ... since this must run on Python 2.4
+    f = open(file_name)
+    try:
+        if cached and cached[3] is not None and st.st_size > cached[1]:
+            parsed = cached[2]
+            digest = md5(f.read(parsed))
+            if digest.hexdigest() == cached[3]:
+                hosts = cached[4].copy()
+        if hosts is None:
+            hosts = {}
+            (parsed, digest) = (0, md5())
+            f.seek(0)
+        while True:
+            line = f.readline()
+            if not line.endswith("\n"):
+                # A line still being written is read again next time, once it is complete
+                if line and f.tell() == st.st_size and os.fstat(f.fileno()).st_size == st.st_size:
+                    gateway_host(line, hosts)
+                    digest = None
+                break
+            gateway_host(line, hosts)
+            parsed += len(line)
+            digest.update(line)
+    finally:
+        f.close()
+
+    if digest is not None:
+        digest = digest.hexdigest()
+    gateway_host_cache[file_name] = (st.st_mtime, st.st_size, parsed, digest, hosts)
+    write_cache(cache_file_name, gateway_host_cache[file_name])
+    return hosts
+
+
+def resolve_targets(config, p_links):
+    """
+    Resolves the targets of the desired persistent links using the reflector/gateway host list.
+    :param config: Configuration snapshot for the g2_link system
+    :param p_links: Dictionary containing desired persistent links by module, as in the configuration snapshot
+    :return: Tuple containing a dictionary of callsign/reflector id (key) to (ip address, port) for every listed
+    target, and a dictionary of module (key) to the reason its target could not be resolved.
+    """
+    addresses = {}
+    invalid = {}
+    file_name = config.hosts_file
+    try:
+        hosts = gateway_hosts(file_name)
+    except (IOError, os.error):
+        hosts = None
+    for module in p_links.keys():
+        (local_module, callsign, remote_module) = p_links[module]
+        if hosts is None:
+            invalid[module] = "could not read %s to resolve %s" % (file_name, callsign)
+        elif callsign not in hosts:
+            invalid[module] = "%s is not listed in %s" % (callsign, file_name)
+        else:
+            addresses[callsign] = hosts[callsign]
+    return addresses, invalid
+
+
+def report_invalid_targets(invalid, file_name):
+    """
+    Reports invalid persistent links, unless the same problem was already reported by an earlier run.  Problems
+    that have been fixed are forgotten, so they are reported again if they return.
+    :param invalid: Dictionary containing module (key) and the reason its persistent link is invalid
+    :param file_name: The file name, including the full path, where reported problems are remembered.
+    """
+    reported = read_cache(file_name)
+    if type(reported) is not list:
+        reported = []
+    current = invalid.items()
+    current.sort()
+    for (module, reason) in current:
+        if (module, reason) not in reported:
+            print "Invalid persistent link for module %s - %s" % (module, reason)
+    if current != reported:
+        write_cache(file_name, current)
+
+
+def probe_packets(callsign, remote_module):
+    """
+    Produces the UDP packets used to check whether a reflector or gateway is reachable, without changing the state
+    of any of our links.
+    :param callsign: The callsign or reflector identifier to be probed
+    :param remote_module: The remote module to be probed
+    :return: Tuple containing the probe packet and the packet to send once the probe is answered.
+    """
+    if callsign.startswith("REF"):
+        return DPLUS_CONNECT, DPLUS_DISCONNECT
+    return ("%-8s%1s%1s\x00" % (ADMIN, PROBE_MODULE, remote_module),
+            "%-8s%1s \x00" % (ADMIN, PROBE_MODULE))
+
+
+def load_probe_cache(file_name):
+    """
+    Adds the probe results saved by earlier runs to the probe cache, unless newer results are already cached.
+    :param file_name: The file name, including the full path, of the probe cache file.
+    """
+    saved = read_cache(file_name)
+    if type(saved) is not dict:
+        return
+    for address in saved.keys():
+        if address not in probe_cache or probe_cache[address][0] < saved[address][0]:
+            probe_cache[address] = saved[address]
+
+
+def save_probe_cache(file_name):
+    """
+    Saves the successful probe results that have not yet expired, so that they may be reused by later runs.  Failed
+    probes are not saved, so that a target is probed again by the next run rather than skipped for PROBE_TTL.
+    :param file_name: The file name, including the full path, of the probe cache file.
+    """
+    now = time.time()
+    current = {}
+    for address in probe_cache.keys():
+        if probe_cache[address][1] and now - probe_cache[address][0] < PROBE_TTL:
+            current[address] = probe_cache[address]
+    write_cache(file_name, current)
+
+
+def probe_reachability(targets, timeout=None, ttl=None):
+    """
+    Probes reflectors/gateways concurrently with UDP packets, reusing cached results that are younger than ttl.
+    Unanswered probes are sent again, up to PROBE_ATTEMPTS times within the timeout, in case a packet was lost.
+    :param targets: Dictionary containing callsign (key) and tuple value of (ip address, port, probe packet,
+    packet to send once answered).
+    :param timeout: Number of seconds to wait for all of the probes to be answered (PROBE_TIMEOUT by default).
+    :param ttl: Number of seconds a cached probe result remains valid (PROBE_TTL by default).
+    :return: Dictionary containing callsign (key) and True if the target answered the probe, False otherwise.
+    """
+    if timeout is None:
+        timeout = PROBE_TIMEOUT
+    if ttl is None:
+        ttl = PROBE_TTL
+    now = time.time()
+    reachable = {}
+    pending = {}
+    for callsign in targets.keys():
+        address = targets[callsign][:2]
+        if address in probe_cache and now - probe_cache[address][0] < ttl:
+            reachable[callsign] = probe_cache[address][1]
+        else:
+            reachable[callsign] = False
+            pending.setdefault(address, []).append(callsign)
+
+    sockets = {}
+    try:
+        for address in pending.keys():
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setblocking(0)
+            sockets[s] = address
+
+        waiting = sockets.keys()
+        deadline = now + timeout
+        interval = float(timeout) / PROBE_ATTEMPTS
+        attempts = 0
+        resend = now
+        while waiting and time.time() < deadline:
+            if attempts < PROBE_ATTEMPTS and time.time() >= resend:
+                for s in waiting:
+                    try:
+                        s.sendto(targets[pending[sockets[s]][0]][2], sockets[s])
+                    except socket.error:
+                        pass
+                attempts += 1
+                resend += interval
+            wake = deadline
+            if attempts < PROBE_ATTEMPTS:
+                wake = min(deadline, resend)
+            try:
+                ready = select.select(waiting, [], [], max(0, wake - time.time()))[0]
+            except select.error:
+                break
+            for s in ready:
+                waiting.remove(s)
+                address = sockets[s]
+                try:
+                    s.recvfrom(1024)
+                except socket.error:
+                    # Typically an ICMP port unreachable, reported on the next socket operation
+                    continue
+                try:
+                    s.sendto(targets[pending[address][0]][3], address)
+                except socket.error:
+                    pass
+                for callsign in pending[address]:
+                    reachable[callsign] = True
+    finally:
+        for s in sockets.keys():
+            s.close()
+
+    for address in pending.keys():
+        probe_cache[address] = (now, reachable[pending[address][0]])
+    return reachable
+
+
+def reachable_targets(p_links, addresses):
+    """
+    Checks which of the distinct targets of the desired persistent links answer a reachability probe.
+    :param p_links: Dictionary containing desired persistent links by module, as produced by persistent_links
+    :param addresses: Dictionary containing callsign/reflector id (key) and (ip address, port), as produced by
+    resolve_targets
+    :return: Dictionary containing callsign/reflector id (key) and True if the target answered a probe.  Targets
+    without an address are never reachable.
+    """
+    targets = {}
+    for (local_module, callsign, remote_module) in p_links.values():
+        if callsign in addresses and callsign not in targets:
+            targets[callsign] = addresses[callsign] + probe_packets(callsign, remote_module)
+    cache_file_name = os.path.join(G2_LINK_DIRECTORY, PROBE_CACHE_FILE)
+    load_probe_cache(cache_file_name)
+    reachable = probe_reachability(targets)
+    if targets:
+        save_probe_cache(cache_file_name)
+    for (local_module, callsign, remote_module) in p_links.values():
+        if callsign not in reachable:
+            reachable[callsign] = False
+    return reachable
+
+
 def format_gateway_command(callsign, remote_module, command):
     """
     Produces a valid URCALL string, given a callsign, remote module and single letter command.
@@ -174,19 +642,17 @@ def format_gateway_command(callsign, remote_module, command):
 def g2link_test(config, cmd, local_module, gateway_command):
     """
     Calls the g2_link command utility to control the g2_link system.
-    :param config: Dictionary containing the configuration variables for the g2_link system
+    :param config: Configuration snapshot for the g2_link system
     :param cmd: Word that indicates the command type (i.e., LINK, UNLINK, HELLO)
     :param local_module: The single letter local module identifier
     :param gateway_command: A URCALL compliant 8-character string
     :return: The return code of the subprocess that is executed
     """
     g2_link_test_cmd = os.path.join(G2_LINK_DIRECTORY, "g2link_test")
-    ip = config["TO_G2_EXTERNAL_IP"]
-    port = config["MY_G2_LINK_PORT"]
-    gateway_callsign = config["LOGIN_CALL"]
     try:
         return subprocess.call(
-            [g2_link_test_cmd, ip, port, cmd, gateway_callsign, local_module, "20", "2", ADMIN, gateway_command])
+            [g2_link_test_cmd, config.gateway_ip, str(config.gateway_port), cmd, config.login_call, local_module,
+             "20", "2", ADMIN, gateway_command])
     except os.error:
         sys.exit("Could not run command %s" % g2_link_test_cmd)
 
@@ -194,7 +660,7 @@ def g2link_test(config, cmd, local_module, gateway_command):
 def link(config, local_module, callsign, remote_module):
     """
     Calls the g2_link command utility to link from a local module to a particular reflector/callsign remote module
-    :param config: Dictionary containing the configuration variables for the g2_link system.
+    :param config: Configuration snapshot for the g2_link system.
     :param local_module: The single letter module identifier for our local system
     :param callsign: The callsign or reflector identifier to which we will link
     :param remote_module: The remote module for the link
@@ -206,22 +672,280 @@ def link(config, local_module, callsign, remote_module):
 def unlink(config, local_module):
     """
     Calls the g2_link command utility to unlink a local module.
-    :param config: Dictionary containing the configuration variables for the g2_link system.
+    :param config: Configuration snapshot for the g2_link system.
     :param local_module: The single letter module identifier for our local system
     :return: The return code from the subprocess
     """
     return g2link_test(config, "UNLINK", local_module, format_gateway_command("", "", "U"))
 
 
-def main():
+def plan(config):
+    """
+    Collects the persistent links, link status and local RF use, and decides what should be done for each module.
+    Only local files are read: nothing is printed, and no commands or probes are sent.  The reachability of new
+    targets is checked when the plan is executed.
+    :param config: Configuration snapshot for the g2_link system
+    :return: Dictionary containing the gateway callsign and a list of actions, ordered by module.  Each action is a
+    dictionary containing the module, the action ('link', 'relink', 'none', 'wait' or 'invalid'), the target,
+    remote module, currently linked callsign/reflector id (or None, if unknown or not linked) and the reason.
+    """
+    p_links = dict(config.persistent_links)
+
+    # Every desired target is validated and resolved before any command is sent, so that no commands are
+    # wasted on targets that do not exist.
+    invalid = dict(config.invalid_links)
+    invalid.update(resolve_targets(config, p_links)[1])
+
+    links = None
+    actions = []
+    modules = p_links.keys() + dict(config.invalid_links).keys()
+    modules.sort()
+    for module in modules:
+        (local_module, callsign, remote_module) = p_links.get(module, (module, '', ''))
+        action = {'module': module, 'target': callsign, 'remote_module': remote_module, 'current': None}
+        if module in invalid:
+            action['action'] = 'invalid'
+            action['reason'] = invalid[module]
+        elif minutes_since_modified(rf_file_name(config, module)) < RF_TIMERS[module]:
+            action['action'] = 'wait'
+            action['reason'] = "The gateway for module %s is being used locally - don't do anything" % module
+        else:
+            if links is None:
+                links = current_links(status_file_name(config))
+            if module in links:
+                action['current'] = links[module][0]
+            if action['current'] == callsign:
+                action['action'] = 'none'
+                action['reason'] = "Nothing to do - persistent link already established for module %s." % module
+            elif action['current'] is None:
+                action['action'] = 'link'
+                action['reason'] = "Establish persistent link for module %s" % module
+            else:
+                action['action'] = 'relink'
+                action['reason'] = "Unlinking from %s and establishing persistent link for module %s to %s, " \
+                                   "module %s" % (action['current'], module, callsign, remote_module)
+        actions.append(action)
+
+    return {'gateway': config.login_call, 'actions': actions}
+
+
+def probe_targets(config, actions):
+    """
+    Validates, resolves and probes the targets of link and relink actions, each distinct target once.
+    :param config: Configuration snapshot for the g2_link system
+    :param actions: List of actions, as produced by plan
+    :return: Tuple containing a dictionary of the reason each target (key) is invalid, and a dictionary containing
+    callsign/reflector id (key) and True if the target answered a probe.
+    """
+    targets = {}
+    for action in actions:
+        targets[action['target']] = (action['module'], action['target'], action['remote_module'])
+    (addresses, invalid) = resolve_targets(config, targets)
+    valid = {}
+    for callsign in targets.keys():
+        if callsign not in invalid:
+            valid[callsign] = targets[callsign]
+    return invalid, reachable_targets(valid, addresses)
+
+
+def execute(config, action):
+    """
+    Sends the g2_link commands required by a link or relink action.
+    :param config: Configuration snapshot for the g2_link system
+    :param action: Dictionary describing the action, as produced by plan
+    :return: The return code from the link subprocess.
+    """
+    if action['action'] == 'relink':
+        unlink(config, action['module'])
+    return link(config, action['module'], action['target'], action['remote_module'])
+
+
+def plan_problem(p):
+    """
+    Checks that a plan read from a file has the structure produced by plan.
+    :param p: The plan, as decoded from JSON
+    :return: Description of the first problem found, or None if the plan is valid.
+    """
+    if type(p) is not dict or 'gateway' not in p or 'actions' not in p:
+        return "a plan must be an object with gateway and actions"
+    if not isinstance(p['gateway'], basestring) or type(p['actions']) is not list:
+        return "the gateway must be text and the actions a list"
+    try:
+        p['gateway'].encode('ascii')
+    except UnicodeError:
+        return "the gateway must be ASCII text"
+    for action in p['actions']:
+        if type(action) is not dict:
+            return "each action must be an object"
+        for k in PLAN_ACTION_KEYS:
+            if k not in action:
+                return "an action has no %s" % k
+            if k == 'current' and action[k] is None:
+                continue
+            if not isinstance(action[k], basestring):
+                return "the %s of an action must be text" % k
+            try:
+                action[k].encode('ascii')
+            except UnicodeError:
+                return "the %s of an action must be ASCII text" % k
+        if action['module'] not in RF_TIMERS:
+            return "unknown module %s" % action['module']
+        if action['action'] not in PLAN_ACTIONS:
+            return "unknown action %s for module %s" % (action['action'], action['module'])
+        if action['action'] in ('link', 'relink'):
+            if not (CALLSIGN.match(action['target']) and MODULE.match(action['remote_module'])):
+                return "%s%s is not a valid link target for module %s" % (action['target'], action['remote_module'],
+                                                                           action['module'])
+            if action['action'] == 'relink' and action['current'] is None:
+                return "the relink action for module %s has no current link" % action['module']
+    return None
+
+
+def load_plan(file_name):
+    """
+    Reads a JSON plan, as produced by the plan command, and exits if it cannot be read or is not valid.
+    :param file_name: The file name, including the full path, or - to read the plan from standard input.
+    :return: Dictionary containing the gateway callsign and list of actions, with all text as plain strings.
+    """
+    try:
+        if file_name == '-':
+            p = json.load(sys.stdin)
+        else:
+            # Could not use with open(file_name) as f: ... since this must run on Python 2.4
+            f = open(file_name)
+            try:
+                p = json.load(f)
+            finally:
+                f.close()
+    except IOError, e:
+        sys.exit("Could not read plan %s: %s" % (file_name, e))
+    except ValueError, e:
+        sys.exit("Invalid plan %s: %s" % (file_name, e))
+
+    problem = plan_problem(p)
+    if problem:
+        sys.exit("Invalid plan %s: %s" % (file_name, problem))
+
+    actions = []
+    for item in p['actions']:
+        action = {}
+        for k in PLAN_ACTION_KEYS:
+            action[k] = item[k]
+            if item[k] is not None:
+                action[k] = str(item[k])
+        actions.append(action)
+    return {'gateway': str(p['gateway']), 'actions': actions}
+
+
+def precondition_failure(config, action, links, invalid, reachable=None):
+    """
+    Checks whether a link or relink action may still be executed.
+    :param config: Configuration snapshot for the g2_link system
+    :param action: Dictionary describing the action, as produced by plan
+    :param links: Dictionary containing the current links by module, as produced by current_links
+    :param invalid: Dictionary containing the reason each target (key) is invalid, as produced by resolve_targets
+    :param reachable: Dictionary containing callsign/reflector id (key) and True if the target answered a probe, or
+    None if reachability has not been checked yet.
+    :return: The reason the action should be skipped, or None if its preconditions hold.
+    """
+    module = action['module']
+    if action['target'] in invalid:
+        return invalid[action['target']]
+    if minutes_since_modified(rf_file_name(config, module)) < RF_TIMERS[module]:
+        return "the gateway is being used locally"
+    if action['action'] == 'link' and module in links:
+        return "module is now linked to %s" % links[module][0]
+    if action['action'] == 'relink' and (module not in links or links[module][0] != action['current']):
+        return "module is no longer linked to %s" % action['current']
+    if reachable is not None and not reachable.get(action['target']):
+        return "%s has not answered a reachability probe" % action['target']
+    return None
+
+
+def apply_plans(config, plans):
+    """
+    Executes the link and relink actions of one or more plans in a single pass.  Duplicate actions are executed
+    once, and actions whose preconditions no longer hold (including those invalidated by an earlier action) are
+    skipped.
+    :param config: Configuration snapshot for the g2_link system
+    :param plans: List of plans, as produced by plan or load_plan
+    :return: The number of actions executed successfully.
+    """
+    pending = []
+    seen = set()
+    for p in plans:
+        if p['gateway'] != config.login_call:
+            print "Skipping plan for gateway %s - this is %s" % (p['gateway'], config.login_call)
+            continue
+        for action in p['actions']:
+            key = (action['module'], action['action'], action['target'], action['remote_module'], action['current'])
+            if action['action'] in ('link', 'relink') and key not in seen:
+                seen.add(key)
+                pending.append(action)
+    if not pending:
+        return 0
+
+    # Only the targets of actions whose other preconditions hold are probed, once for the whole batch
+    links = current_links(status_file_name(config))
+    (invalid, reachable) = probe_targets(config, [action for action in pending
+                                                  if not precondition_failure(config, action, links, {})])
+
+    executed = 0
+    for action in pending:
+        reason = precondition_failure(config, action, links, invalid, reachable)
+        if reason:
+            print "Skipping %s of module %s to %s - %s" % (action['action'], action['module'], action['target'],
+                                                          reason)
+            continue
+        print action['reason']
+        result = execute(config, action)
+        if result == 0:
+            links[action['module']] = [action['target'], action['remote_module']]
+            executed += 1
+        else:
+            print "Failed to %s module %s to %s - g2link_test returned %s" % (action['action'], action['module'],
+                                                                              action['target'], result)
+            # The link state is unknown, so later actions are checked against what g2_link reports
+            links = current_links(status_file_name(config))
+    return executed
+
+
+def main(args=()):
     """
     Establishes persistent links for each module where a desired persistent link exists, if needed and
-    if there has been no local traffic for the requisite amount of time.
+    if there has been no local traffic for the requisite amount of time.  With the plan command, the actions
+    are printed as a JSON plan instead of being executed.  With the apply command, the actions of one or more
+    JSON plans are executed, if their preconditions still hold.
+    :param args: Command line arguments: nothing, plan, or apply followed by plan file names (- for standard input)
     :return: 0, if successful
     """
-    config = fetch_configuration(os.path.join(G2_LINK_DIRECTORY, "g2_link.cfg"))
+    if args and args[0] not in ('plan', 'apply'):
+        sys.exit("Usage: persistent_links.py [plan | apply [plan_file ...]]")
+    if args and json is None:
+        sys.exit("The plan and apply commands require the json (Python 2.6+) or simplejson module")
 
-    p_links = persistent_links(config)
+    try:
+        config = load_configuration(os.path.join(G2_LINK_DIRECTORY, "g2_link.cfg"))
+    except ConfigurationError, e:
+        sys.exit("Invalid g2_link configuration: %s" % e)
+
+    if args and args[0] == 'plan':
+        print json.dumps(plan(config), sort_keys=True, indent=2)
+        return 0
+
+    if args and args[0] == 'apply':
+        file_names = args[1:]
+        if not file_names:
+            file_names = ['-']
+        plans = []
+        for file_name in file_names:
+            plans.append(load_plan(file_name))
+        print '------------------------------------------'
+        print datetime.datetime.today()
+        apply_plans(config, plans)
+        return 0
+
+    p = plan(config)
 
     print '------------------------------------------'
     print datetime.datetime.today()
@@ -230,25 +954,29 @@ def main():
     #     If the gateway is being used locally, don't do anything
     #     Otherwise, we should ensure we are linked to the correct, persistent link, assuming
     #     the machine has been inactive long enough and is not already linked to the desired target.
-
-    for module in p_links.keys():
-        if minutes_since_modified(rf_file_name(config, module)) < RF_TIMERS[module]:
-            print "The gateway for module %s is being used locally - don't do anything" % module
+    #     A link is only established once the desired target has answered a reachability probe, so that
+    #     a working link is not dropped in favor of a dead reflector.
+
+    invalid = {}
+    for action in p['actions']:
+        if action['action'] == 'invalid':
+            invalid[action['module']] = action['reason']
+        elif action['action'] not in ('link', 'relink'):
+            print action['reason']
+    report_invalid_targets(invalid, os.path.join(G2_LINK_DIRECTORY, REPORTED_TARGETS_FILE))
+
+    switching = [action for action in p['actions'] if action['action'] in ('link', 'relink')]
+    reachable = probe_targets(config, switching)[1]
+    for action in switching:
+        if reachable.get(action['target']):
+            print action['reason']
+            execute(config, action)
         else:
-            links = current_links(status_file_name(config))
-            if not module in links:
-                print "Establish persistent link for module %s" % module
-                link(config, module, p_links[module][1], p_links[module][2])
-            elif links[module][0] != p_links[module][1]:
-                print "Unlinking from %s and establishing persistent link for module %s to %s, module %s" % (
-                    links[module][0], module, p_links[module][1], p_links[module][2])
-                unlink(config, module)
-                link(config, module, p_links[module][1], p_links[module][2])
-            else:
-                print "Nothing to do - persistent link already established for module %s." % module
+            print "%s has not answered a reachability probe - not linking module %s" % (action['target'],
+                                                                                         action['module'])
     return 0
 
 
 if __name__ == '__main__':
 
-    sys.exit(main())
+    sys.exit(main(sys.argv[1:]))